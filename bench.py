@@ -1,6 +1,77 @@
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, deque
+import argparse
+import hashlib
+import math
+import operator
+import os
 import sys, traceback
 
+_TRANSACTION_FIELDS = ("Date", "Ledger", "Amount", "Company")
+_required_transaction_fields = frozenset(_TRANSACTION_FIELDS)
+# pulls the fields of a transaction record out of its json object in a single call
+_get_transaction_fields = operator.itemgetter(*_TRANSACTION_FIELDS)
+# pulls the fields of a page out of the decoded response in a single call
+_get_page_fields = operator.itemgetter("transactions", "page", "totalCount")
+# reads the amount of a Transaction without an interpreter frame per call
+_get_amount = operator.attrgetter("amount")
+
+DEFAULT_CACHE_DIR = ".bench_cache"
+
+
+def _iter_valid_records(transactions):
+    '''
+    input: a list of json objects
+    yields the (date, ledger, amount, company) fields of every json object that is a valid transaction
+    '''
+    # local names are looked up faster than globals and attributes in the per-record loop
+    required_fields = _required_transaction_fields
+    get_fields = _get_transaction_fields
+    intern = sys.intern
+    for trans in transactions:
+        if type(trans) is not dict or not trans.keys() >= required_fields:
+            #ignoring the record if it is not a json object or does not have Date, Ledger, Amount, or Company. 
+            # We could potentially keep the ones that are missing only Company or Ledger
+            continue
+        date, ledger, amount, company = get_fields(trans)
+        try:
+            # dates repeat across many records, interning them keeps a single copy of each
+            # and lets the date comparisons succeed on identity
+            date = intern(date)
+            amount = float(amount)
+        except (ValueError, TypeError):
+            #ignore the record if it does not have a numeral Amount field or a textual Date field
+            continue
+        # ledgers and companies repeat as well, but a record is kept even if they are not text
+        if type(ledger) is str:
+            ledger = intern(ledger)
+        if type(company) is str:
+            company = intern(company)
+        yield date, ledger, amount, company
+
+
+def _add_exact(partials, x):
+    '''
+    adds x to partials, a list of non-overlapping floats whose sum is exact,
+    so that math.fsum(partials) stays the correctly rounded sum of every number added.
+    This is the algorithm math.fsum uses, kept open to read the running sum after each step.
+    '''
+    i = 0
+    for y in partials:
+        if abs(x) < abs(y):
+            x, y = y, x
+        hi = x + y
+        lo = y - (hi - x)
+        if lo:
+            partials[i] = lo
+            i += 1
+        x = hi
+    partials[i:] = [x]
+
+
 class MismatchingTotalCountError(Exception):
     '''
     This error is thrown when one of the subsequent pages
@@ -17,6 +88,8 @@ class MismatchingPageNumber(Exception):
 
 class Page:
     '''stores the total_count and transactions reveived from a page'''
+    __slots__ = ("page_num", "total_count", "transactions")
+
     def __init__(self, page_num ,total_count, transactions):
         self.page_num = page_num
         self.total_count = total_count
@@ -25,6 +98,8 @@ class Page:
 
 class Transaction:
     '''The transactions read from API are deserialized into objects of this class'''
+    __slots__ = ("date", "ledger", "amount", "company")
+
     def __init__(self, date, ledger, amount, company):
         self.date = date
         self.ledger = ledger
@@ -34,6 +109,8 @@ class Transaction:
 
 class DailyRunningBalance:
     '''a pair data structure storing the date and its daily running balance'''
+    __slots__ = ("date", "running_balance")
+
     def __init__(self, date, running_balance):
         self.date = date
         self.running_balance = running_balance
@@ -45,10 +122,77 @@ class BenchAPIDAO:
     It retrieves transactions from the API, stores them
     in the transactions attribute and calculates running 
     daily sum as well as total sum.
+    If cache_dir is given, the body of every page retrieved is saved in that
+    directory and read from there instead of the API on subsequent runs.
+    Pages are cached separately for every base_url.
     '''
-    def __init__(self, base_url="http://resttest.bench.co/transactions/{page}.json"):
+    def __init__(self, base_url="http://resttest.bench.co/transactions/{page}.json", cache_dir=None):
         self.base_url = base_url
+        self.cache_dir = cache_dir
+        self._url_fmt = base_url.format
+        # pages of different APIs must not be read from each other's cache
+        self._cache_key = hashlib.sha1(base_url.encode()).hexdigest()
         self.transactions = []
+        # a single session keeps the connection to the server alive across pages
+        self.session = requests.Session()
+        self.session.headers.update({"Accept-Encoding": "gzip", "Connection": "keep-alive"})
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        '''releases the connections held by the session'''
+        self.session.close()
+
+    def _cache_path(self, page_num):
+        return os.path.join(self.cache_dir, self._cache_key, "%d.json" % page_num)
+
+    def _read_cached_page(self, page_num):
+        '''
+        returns the totalCount and the list of json transaction records of the cached page,
+        or None if caching is disabled or there is no valid copy of the page in the cache
+        '''
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._cache_path(page_num), "rb") as cache_file:
+                content = cache_file.read()
+        except OSError:
+            return None
+        try:
+            return BenchAPIDAO._parse_page(page_num, content)
+        except (ValueError, TypeError, KeyError, MismatchingPageNumber):
+            #the cached copy is ignored and replaced once the page is retrieved again
+            print("The cached copy of page %d is invalid. Retrieving it again" % page_num)
+            return None
+
+    def _write_cached_page(self, page_num, content):
+        '''
+        saves the body of the page in the cache, replacing the file atomically so readers never see a partial page.
+        A warning is printed if the page cannot be saved.
+        '''
+        if self.cache_dir is None:
+            return
+        path = self._cache_path(page_num)
+        tmp_path = path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "wb") as cache_file:
+                cache_file.write(content)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # the cache is only an optimization, the page has been retrieved either way
+            print("Could not save page %d in the cache at %s: %s" % (page_num, path, e))
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
 
     @staticmethod
     def convert_json_to_transaction_list(transactions):
@@ -56,24 +200,42 @@ class BenchAPIDAO:
         input: a list of json objects
         output: a list of Transaction objects
         '''
-        result = []
-        for trans in transactions:
-            try:
-                newTrans = Transaction(trans["Date"], trans["Ledger"], float(trans["Amount"]), trans["Company"])
-            except ValueError:
-                #ignore the record if it does not have a numeral Amount field
-                continue
-            except KeyError:
-                #ignoring the record if it does not have Date, Ledger, Amount, or Company. 
-                # We could potentially keep the ones that are missing only Company or Ledger
-                continue
-            result.append(newTrans)
-        return result
+        return [Transaction(date, ledger, amount, company)
+                for date, ledger, amount, company in _iter_valid_records(transactions)]
 
     def retrieve_next_page(self, page_num):
         '''
         input: page_number
-        output: a list of Transaction objects of all transactions on the page
+        output: a Page holding the Transaction objects of all transactions on the page
+        '''
+        total_count, _, transactions = self._retrieve_page_transactions(page_num)
+        return Page(page_num, total_count, transactions)
+
+    def _retrieve_page_transactions(self, page_num):
+        '''
+        input: page_number
+        output: the totalCount, the number of records the server sent and the list of
+        Transaction objects of the valid records on the page
+        '''
+        total_count, records = self._retrieve_page_records(page_num)
+        return total_count, len(records), BenchAPIDAO.convert_json_to_transaction_list(records)
+
+    @staticmethod
+    def _parse_page(page_num, content):
+        '''
+        input: page_number and the body of the page
+        output: the totalCount and the list of json transaction records on the page
+        '''
+        resp_json = orjson.loads(content)
+        records, response_page_num, total_count = _get_page_fields(resp_json)
+        if response_page_num != page_num:
+            raise MismatchingPageNumber("Asked for page %d, but server responded with page %d" % (page_num, response_page_num))
+        return total_count, records
+
+    def _retrieve_page_records(self, page_num):
+        '''
+        input: page_number
+        output: the totalCount and the list of json transaction records on the page
         retrieves the page with page number equal to page_num.
         The program will give an appropriate message and exit if the response cannot be decoded 
         into json or if the json does not have totalCount or transactions fields.
@@ -81,16 +243,17 @@ class BenchAPIDAO:
         MAX_NUM_REQUEST_TRIES = 2
         TIME_OUT_SECONDS = 5
         num_tries = 0
-        url = self.base_url.format(page=page_num)
+        url = self._url_fmt(page=page_num)
+        cached_page = self._read_cached_page(page_num)
+        if cached_page is not None:
+            return cached_page
         while num_tries < MAX_NUM_REQUEST_TRIES:
             try:
-                response = requests.get(url, timeout = TIME_OUT_SECONDS)
+                response = self.session.get(url, timeout = TIME_OUT_SECONDS)
                 response.raise_for_status()         #throws an exception if we get HTTP codes other than 2xx
-                resp_json = response.json()
-                transactions = BenchAPIDAO.convert_json_to_transaction_list(resp_json["transactions"])
-                if resp_json["page"] != page_num:
-                    raise MismatchingPageNumber("Asked for page %d, but server responded with page %d" % (page_num, resp_json["page"]))
-                return Page(page_num, resp_json["totalCount"], transactions)
+                total_count, records = BenchAPIDAO._parse_page(page_num, response.content)
+                self._write_cached_page(page_num, response.content)
+                return total_count, records
             except requests.exceptions.Timeout as e:
                 print("GET request to %s timed out. Retrying" % url)
                 num_tries += 1
@@ -115,25 +278,88 @@ class BenchAPIDAO:
                 traceback.print_exc(file=sys.stdout)
                 sys.exit(1)
         
-    def pull_all_transactions(self):
+    def _iter_pages(self, max_workers):
+        '''
+        yields (page_num, total_count, transactions) for every page, in page order.
+        The first page tells us the total count and the page size, so the
+        remaining pages are requested concurrently over the shared session.
+        At most max_workers pages are in flight at a time, so the pages fetched
+        ahead of the consumer do not pile up in memory.
+        If those pages still hold fewer than total count records, the pages after
+        them are read one after the other until the total count is reached or
+        an empty page is received.
+        '''
+        total_count, num_records, transactions = self._retrieve_page_transactions(1)
+        yield 1, total_count, transactions
+        num_records_read = num_records
+        num_pages = math.ceil(total_count / num_records) if num_records else 1
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            in_flight = deque()
+            next_page_num = 2
+            for page_num in range(2, num_pages + 1):
+                while next_page_num <= num_pages and len(in_flight) < max_workers:
+                    in_flight.append(executor.submit(self._retrieve_page_transactions, next_page_num))
+                    next_page_num += 1
+                page_total_count, num_records, transactions = in_flight.popleft().result()
+                yield page_num, page_total_count, transactions
+                num_records_read += num_records
+        # the page count assumes every page holds as many records as the first one
+        page_num = num_pages + 1
+        while num_records_read < total_count:
+            page_total_count, num_records, transactions = self._retrieve_page_transactions(page_num)
+            if num_records == 0:
+                break
+            yield page_num, page_total_count, transactions
+            num_records_read += num_records
+            page_num += 1
+
+    def pull_all_transactions(self, max_workers=8):
         '''pulls all transactions from the API and stores them in self.transactions'''
+        transactions = None
+        total_count = None
+        offset = 0
+        for page_num, page_total_count, page_transactions in self._iter_pages(max_workers):
+            if total_count is None:
+                total_count = page_total_count
+                # the total count is known, so the list is allocated once and filled page by page
+                transactions = self.transactions = [None] * total_count
+            elif total_count != page_total_count:
+                raise MismatchingTotalCountError("The total count on page %d does not match the total count on first page" % page_num)
+            num_transactions = len(page_transactions)
+            transactions[offset:offset + num_transactions] = page_transactions
+            offset += num_transactions
+            print("read page %d with %d records" % (page_num, num_transactions))
+        # records that were dropped while converting leave unused slots at the end
+        del transactions[offset:]
+        print("done reading all records")
+
+    def streaming_total_balance(self):
+        '''
+        calculates the total balance of all transactions in the API page by page,
+        without creating Transaction objects or storing them in self.transactions.
+        This is an alternative to pull_all_transactions() followed by
+        calculate_total_balance() when only the total is needed.
+        '''
+        page_totals = []
         num_records_read = 0
         total_count = None
         current_page = 1
-        while (total_count == None) or (num_records_read < total_count):
-            page = self.retrieve_next_page(current_page)
-            self.transactions.extend(page.transactions)
-            if total_count == None:
-                total_count = page.total_count
-            elif total_count != page.total_count:
+        while (total_count is None) or (num_records_read < total_count):
+            page_total_count, records = self._retrieve_page_records(current_page)
+            if total_count is None:
+                total_count = page_total_count
+            elif total_count != page_total_count:
                 raise MismatchingTotalCountError("The total count on page %d does not match the total count on first page" % current_page)
-            print("read page %d with %d records" % (page.page_num, len(page.transactions)))
-            num_records_read += len(page.transactions)
+            if len(records) == 0:
+                break
+            page_totals.append(math.fsum(amount for _, _, amount, _ in _iter_valid_records(records)))
+            num_records_read += len(records)
             current_page += 1
-        print("done reading all records")
+        return math.fsum(page_totals)
 
     def calculate_total_balance(self):
-        return sum(t.amount for t in self.transactions)
+        '''returns the exactly rounded sum of the amounts of all transactions'''
+        return math.fsum(map(_get_amount, self.transactions))
     
     def calculate_running_daily_balance(self):
         '''
@@ -141,35 +367,42 @@ class BenchAPIDAO:
         calculates the balance up until that date.
         output: list of DailyRunningBalance objects
         '''
-        self.transactions.sort(key =lambda t: t.date)
+        # grouping by date first means only the distinct dates need sorting,
+        # and self.transactions is left in the order it was read
+        daily_amounts = defaultdict(list)
+        for trans in self.transactions:
+            daily_amounts[trans.date].append(trans.amount)
+        # the running balances are summed exactly, like calculate_total_balance,
+        # so the last one is equal to the total balance
+        partials = []
         running_daily = []
-        prev_date = None
-        if len(self.transactions) == 0:
-            return running_daily
-        else:
-            prev_date = self.transactions[0].date
-        running_sum = 0
-        for i, trans in enumerate(self.transactions):
-            if trans.date != prev_date:
-                running_daily.append(DailyRunningBalance(prev_date, running_sum))
-                prev_date = trans.date
-            running_sum += trans.amount
-            if i == len(self.transactions)-1:
-                running_daily.append(DailyRunningBalance(trans.date, running_sum))
+        for date in sorted(daily_amounts):
+            for amount in daily_amounts[date]:
+                _add_exact(partials, amount)
+            running_daily.append(DailyRunningBalance(date, math.fsum(partials)))
         return running_daily
 
     @staticmethod
     def print_running_daily_balance(running_daily_balance):
-        for record in running_daily_balance:
-            print("date: %s\trunning balance: %.2f" % (record.date, record.running_balance))
+        # the report is built in memory and written to stdout in one call
+        sys.stdout.write("".join(["date: %s\trunning balance: %.2f\n" % (record.date, record.running_balance)
+                                  for record in running_daily_balance]))
 
 
-if __name__ == "__main__":
-    benchDAO = BenchAPIDAO()
-    benchDAO.pull_all_transactions()
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Calculates the total and running daily balances of all transactions from the Bench API")
+    parser.add_argument("--no-cache", action="store_true", help="always download the pages instead of reading them from %s" % DEFAULT_CACHE_DIR)
+    args = parser.parse_args(argv)
+
+    with BenchAPIDAO(cache_dir=None if args.no_cache else DEFAULT_CACHE_DIR) as benchDAO:
+        benchDAO.pull_all_transactions()
 
     total_balance = benchDAO.calculate_total_balance()
     print("\n** total balance: %.2f\n" % total_balance)
 
     running_daily_balance = benchDAO.calculate_running_daily_balance()
-    BenchAPIDAO.print_running_daily_balance(running_daily_balance)
\ No newline at end of file
+    BenchAPIDAO.print_running_daily_balance(running_daily_balance)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,12 @@
 import unittest
 import json
+import os
+import tempfile
+import io
 import unittest.mock as mock
 
-from bench import BenchAPIDAO, Transaction, DailyRunningBalance
+import bench
+from bench import BenchAPIDAO, Transaction, DailyRunningBalance, MismatchingTotalCountError, MismatchingPageNumber
 import requests
 
 resp_json = {
@@ -35,11 +39,9 @@ class BenchDAOTestCase(unittest.TestCase):
         # set status code and content
         mock_resp.status_code = status
         mock_resp.content = content
-        # add json data if provided
+        # serialize json data into the content if provided
         if json_data:
-            mock_resp.json = mock.Mock(
-                return_value=json_data
-            )
+            mock_resp.content = json.dumps(json_data).encode()
         return mock_resp
 
     def test_convert_json_to_transaction_list_one_record(self):
@@ -51,25 +53,58 @@ class BenchDAOTestCase(unittest.TestCase):
         transactions = self.benchDAO.convert_json_to_transaction_list([{"Date": "2013-12-13","Ledger": "Insurance Expense","Company": "Bench"}])
         self.assertEqual(len(transactions), 0)
 
-    @mock.patch.object(requests, 'get')
+    def test_convert_json_to_transaction_list_shares_equal_strings(self):
+        records = [{"Date": "".join(["2013-12-", "13"]), "Ledger": "".join(["Insurance ", "Expense"]),
+                    "Amount": "1", "Company": "".join(["Ben", "ch"])}
+                   for _ in range(2)]
+        transactions = self.benchDAO.convert_json_to_transaction_list(records)
+        self.assertIs(transactions[0].date, transactions[1].date)
+        self.assertIs(transactions[0].ledger, transactions[1].ledger)
+        self.assertIs(transactions[0].company, transactions[1].company)
+
+    def test_convert_json_to_transaction_list_skips_records_that_are_not_objects(self):
+        transactions = self.benchDAO.convert_json_to_transaction_list(["abc", 5, None, resp_json["transactions"][0]])
+        self.assertEqual(len(transactions), 1)
+        self.assertEqual(transactions[0].amount, -100.81)
+
+    def test_convert_json_to_transaction_list_keeps_records_with_null_ledger_and_company(self):
+        transactions = self.benchDAO.convert_json_to_transaction_list([{"Date": "2013-12-13", "Ledger": None, "Amount": "5", "Company": None}])
+        self.assertEqual(len(transactions), 1)
+        self.assertEqual(transactions[0].amount, 5)
+        self.assertIsNone(transactions[0].ledger)
+        self.assertIsNone(transactions[0].company)
+
+    @mock.patch.object(requests.Session, 'get')
     def test_retrieve_next_page_connection_error(self, mock_get):
         mock_get.side_effect = requests.exceptions.ConnectionError()
         with self.assertRaises(SystemExit):
             self.benchDAO.retrieve_next_page(4)
     
-    @mock.patch.object(requests, 'get')
+    @mock.patch.object(requests.Session, 'get')
     def test_retrieve_next_page_timeout_error(self, mock_get):
         mock_get.side_effect = requests.exceptions.Timeout()
         with self.assertRaises(SystemExit):
             self.benchDAO.retrieve_next_page(4)
         
-    @mock.patch.object(requests, 'get')
+    @mock.patch.object(requests.Session, 'get')
     def test_retrieve_next_page_timeout_followed_by_reponse(self, mock_get):
         mock_get.side_effect = [requests.exceptions.Timeout(), self._mock_response(json_data=resp_json)]
         page = self.benchDAO.retrieve_next_page(4)
         self.assertEqual(page.transactions[0].amount, -100.81)
 
-    @mock.patch.object(requests, 'get')
+    @mock.patch.object(requests.Session, 'get')
+    def test_retrieve_next_page_response_missing_total_count(self, mock_get):
+        mock_get.return_value = self._mock_response(json_data={"page": 4, "transactions": []})
+        with self.assertRaises(SystemExit):
+            self.benchDAO.retrieve_next_page(4)
+
+    @mock.patch.object(requests.Session, 'get')
+    def test_retrieve_next_page_mismatching_page_number(self, mock_get):
+        mock_get.return_value = self._mock_response(json_data=resp_json)
+        with self.assertRaises(MismatchingPageNumber):
+            self.benchDAO.retrieve_next_page(3)
+
+    @mock.patch.object(requests.Session, 'get')
     def test_retrieve_next_page_response_with_one_record(self, mock_get):
         mock_resp = self._mock_response(json_data=resp_json)
         mock_get.return_value = mock_resp
@@ -80,7 +115,7 @@ class BenchDAOTestCase(unittest.TestCase):
         self.assertEqual(page.transactions[0].company, "Bench")
         self.assertEqual(page.transactions[0].ledger, "Insurance Expense")
 
-    @mock.patch.object(requests, 'get')
+    @mock.patch.object(requests.Session, 'get')
     def test_retrieve_next_page_response_with_two_records(self, mock_get):
         resp_json = {
             "totalCount": 5,
@@ -107,7 +142,7 @@ class BenchDAOTestCase(unittest.TestCase):
         self.assertEqual(page.transactions[0].amount, -100.81)
         self.assertEqual(page.transactions[1].amount, -1000)
 
-    @mock.patch.object(requests, 'get')
+    @mock.patch.object(requests.Session, 'get')
     def test_pull_all_transactions_with_two_pages(self, mock_get):
         resp_json_1 = {
             "totalCount": 2,
@@ -140,7 +175,67 @@ class BenchDAOTestCase(unittest.TestCase):
         self.assertEqual(self.benchDAO.transactions[0].amount, -100.81)
         self.assertEqual(self.benchDAO.transactions[1].amount, -5.43)
 
-    @mock.patch.object(requests, 'get')
+    def _mock_pages(self, total_count, amounts_per_page):
+        '''returns a side effect for Session.get that responds based on the requested page'''
+        def get(url, timeout=None):
+            page_num = int(url.split("/")[-1].split(".")[0])
+            return self._mock_response(json_data={
+                "totalCount": total_count,
+                "page": page_num,
+                "transactions": [{"Date": "2013-12-13", "Ledger": "Insurance Expense", "Amount": str(amount), "Company": "Bench"}
+                                 for amount in amounts_per_page[page_num - 1]]
+            })
+        return get
+
+    @mock.patch.object(requests.Session, 'get')
+    def test_pull_all_transactions_keeps_page_order(self, mock_get):
+        mock_get.side_effect = self._mock_pages(5, [[1, 2], [3, 4], [5]])
+
+        self.benchDAO.pull_all_transactions()
+        self.assertEqual(mock_get.call_count, 3)
+        self.assertEqual([t.amount for t in self.benchDAO.transactions], [1, 2, 3, 4, 5])
+
+    @mock.patch.object(requests.Session, 'get')
+    def test_pull_all_transactions_with_uneven_page_sizes(self, mock_get):
+        mock_get.side_effect = self._mock_pages(5, [[1, 2], [3], [4], [5]])
+
+        self.benchDAO.pull_all_transactions()
+        self.assertEqual(mock_get.call_count, 4)
+        self.assertEqual([t.amount for t in self.benchDAO.transactions], [1, 2, 3, 4, 5])
+        self.assertEqual(self.benchDAO.calculate_total_balance(), 15)
+
+    @mock.patch.object(requests.Session, 'get')
+    def test_pull_all_transactions_stops_at_empty_page(self, mock_get):
+        mock_get.side_effect = self._mock_pages(5, [[1, 2], [3], [4], []])
+
+        self.benchDAO.pull_all_transactions()
+        self.assertEqual(mock_get.call_count, 4)
+        self.assertEqual([t.amount for t in self.benchDAO.transactions], [1, 2, 3, 4])
+
+    @mock.patch.object(requests.Session, 'get')
+    def test_pull_all_transactions_skips_malformed_records(self, mock_get):
+        mock_get.side_effect = self._mock_pages(4, [[1, "abc"], [3, 4]])
+
+        self.benchDAO.pull_all_transactions()
+        self.assertEqual([t.amount for t in self.benchDAO.transactions], [1, 3, 4])
+
+    @mock.patch.object(requests.Session, 'get')
+    def test_pull_all_transactions_with_more_records_than_total_count(self, mock_get):
+        mock_get.side_effect = self._mock_pages(3, [[1, 2], [3, 4]])
+
+        self.benchDAO.pull_all_transactions()
+        self.assertEqual([t.amount for t in self.benchDAO.transactions], [1, 2, 3, 4])
+
+    @mock.patch.object(requests.Session, 'get')
+    def test_pull_all_transactions_with_mismatching_total_count(self, mock_get):
+        first_page = self._mock_pages(4, [[1, 2], [3, 4]])
+        second_page = self._mock_pages(5, [[1, 2], [3, 4]])
+        mock_get.side_effect = lambda url, timeout=None: (first_page if url.endswith("/1.json") else second_page)(url, timeout)
+
+        with self.assertRaises(MismatchingTotalCountError):
+            self.benchDAO.pull_all_transactions()
+
+    @mock.patch.object(requests.Session, 'get')
     def test_pull_all_transactions_with_one_page(self, mock_get):
         resp_json_1 = {
             "totalCount": 1,
@@ -159,7 +254,7 @@ class BenchDAOTestCase(unittest.TestCase):
         self.benchDAO.pull_all_transactions()
         self.assertEqual(self.benchDAO.transactions[0].amount, -100.81)
 
-    @mock.patch.object(requests, 'get')
+    @mock.patch.object(requests.Session, 'get')
     def test_pull_all_transactions_with_one_page_but_no_records(self, mock_get):
         resp_json_1 = {
             "totalCount": 0,
@@ -172,16 +267,141 @@ class BenchDAOTestCase(unittest.TestCase):
         self.benchDAO.pull_all_transactions()
         self.assertEqual(len(self.benchDAO.transactions), 0)
 
+    @mock.patch.object(requests.Session, 'get')
+    def test_retrieve_next_page_reads_cached_page(self, mock_get):
+        mock_get.return_value = self._mock_response(json_data=resp_json)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            benchDAO = BenchAPIDAO("test.com/{page}.json", cache_dir=cache_dir)
+            benchDAO.retrieve_next_page(4)
+            self.assertTrue(os.path.isfile(benchDAO._cache_path(4)))
+
+            page = BenchAPIDAO("test.com/{page}.json", cache_dir=cache_dir).retrieve_next_page(4)
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(page.transactions[0].amount, -100.81)
+
+    def test_write_cached_page_with_unwritable_cache_dir(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # a regular file cannot hold the cached pages
+            cache_dir = os.path.join(tmp_dir, "not_a_directory")
+            open(cache_dir, "w").close()
+            benchDAO = BenchAPIDAO("test.com/{page}.json", cache_dir=cache_dir)
+            with mock.patch("sys.stdout", new_callable=io.StringIO) as mock_stdout:
+                benchDAO._write_cached_page(1, b"{}")
+            self.assertEqual(os.listdir(tmp_dir), ["not_a_directory"])
+        self.assertIn("Could not save page 1 in the cache", mock_stdout.getvalue())
+
+    @mock.patch.object(requests.Session, 'get')
+    def test_pull_all_transactions_with_unwritable_cache_dir(self, mock_get):
+        mock_get.side_effect = self._mock_pages(3, [[1, 2], [3]])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # a regular file cannot hold the cached pages
+            cache_dir = os.path.join(tmp_dir, "not_a_directory")
+            open(cache_dir, "w").close()
+            benchDAO = BenchAPIDAO("test.com/{page}.json", cache_dir=cache_dir)
+            with mock.patch("sys.stdout", new_callable=io.StringIO):
+                benchDAO.pull_all_transactions()
+        self.assertEqual([t.amount for t in benchDAO.transactions], [1, 2, 3])
+
+    @mock.patch.object(requests.Session, 'get')
+    def test_retrieve_next_page_replaces_truncated_cached_page(self, mock_get):
+        mock_get.return_value = self._mock_response(json_data=resp_json)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            benchDAO = BenchAPIDAO("test.com/{page}.json", cache_dir=cache_dir)
+            benchDAO.retrieve_next_page(4)
+            with open(benchDAO._cache_path(4), "r+b") as cache_file:
+                cache_file.truncate(10)
+
+            page = BenchAPIDAO("test.com/{page}.json", cache_dir=cache_dir).retrieve_next_page(4)
+            self.assertEqual(mock_get.call_count, 2)
+            self.assertEqual(page.transactions[0].amount, -100.81)
+            with open(benchDAO._cache_path(4), "rb") as cache_file:
+                self.assertEqual(json.loads(cache_file.read()), resp_json)
+
+    @mock.patch.object(requests.Session, 'get')
+    def test_retrieve_next_page_ignores_cached_page_with_wrong_page_number(self, mock_get):
+        mock_get.return_value = self._mock_response(json_data=resp_json)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            benchDAO = BenchAPIDAO("test.com/{page}.json", cache_dir=cache_dir)
+            os.makedirs(os.path.dirname(benchDAO._cache_path(4)))
+            with open(benchDAO._cache_path(4), "wb") as cache_file:
+                cache_file.write(json.dumps(dict(resp_json, page=3)).encode())
+
+            page = benchDAO.retrieve_next_page(4)
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(page.page_num, 4)
+
+    @mock.patch.object(requests.Session, 'get')
+    def test_retrieve_next_page_does_not_share_cache_between_base_urls(self, mock_get):
+        mock_get.return_value = self._mock_response(json_data=resp_json)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            BenchAPIDAO("test.com/{page}.json", cache_dir=cache_dir).retrieve_next_page(4)
+            BenchAPIDAO("other.com/{page}.json", cache_dir=cache_dir).retrieve_next_page(4)
+        self.assertEqual(mock_get.call_count, 2)
+
+    @mock.patch.object(requests.Session, 'get')
+    def test_retrieve_next_page_does_not_cache_invalid_page(self, mock_get):
+        mock_get.return_value = self._mock_response(json_data=resp_json)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            benchDAO = BenchAPIDAO("test.com/{page}.json", cache_dir=cache_dir)
+            with self.assertRaises(MismatchingPageNumber):
+                benchDAO.retrieve_next_page(3)
+            self.assertFalse(os.path.exists(benchDAO._cache_path(3)))
+
+    def _run_main(self, argv):
+        '''runs bench.main with a mocked BenchAPIDAO and returns the mocked class'''
+        with mock.patch("bench.BenchAPIDAO") as mock_dao_class, mock.patch("sys.stdout", new_callable=io.StringIO):
+            mock_dao = mock_dao_class.return_value.__enter__.return_value
+            mock_dao.calculate_total_balance.return_value = 0.0
+            bench.main(argv)
+        return mock_dao_class
+
+    def test_main_uses_cache_by_default(self):
+        mock_dao_class = self._run_main([])
+        mock_dao_class.assert_called_once_with(cache_dir=bench.DEFAULT_CACHE_DIR)
+
+    def test_main_with_no_cache(self):
+        mock_dao_class = self._run_main(["--no-cache"])
+        mock_dao_class.assert_called_once_with(cache_dir=None)
+
+    @mock.patch.object(requests.Session, 'close')
+    def test_context_manager_closes_session(self, mock_close):
+        with BenchAPIDAO("test.com/{page}.json") as benchDAO:
+            self.assertIsInstance(benchDAO, BenchAPIDAO)
+        mock_close.assert_called_once_with()
+
+    @mock.patch.object(requests.Session, 'get')
+    def test_streaming_total_balance(self, mock_get):
+        mock_get.side_effect = self._mock_pages(4, [[1.5, "abc"], [3, -4]])
+
+        self.assertEqual(self.benchDAO.streaming_total_balance(), 0.5)
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(len(self.benchDAO.transactions), 0)
+
     def test_calculate_total_balance_with_three_records(self):
         self.benchDAO.transactions = [Transaction("2018-01-01", "CIBC", 1.5, "Bench"),
                                     Transaction("2018-01-01", "CIBC", -4.5, "Bench"),
                                     Transaction("2018-01-01", "CIBC", 5, "Bench")]
         self.assertEqual(self.benchDAO.calculate_total_balance(), 2)
 
+    def test_calculate_total_balance_does_not_accumulate_rounding_errors(self):
+        self.benchDAO.transactions = [Transaction("2018-01-01", "CIBC", 0.1, "Bench") for _ in range(10)]
+        self.assertEqual(self.benchDAO.calculate_total_balance(), 1.0)
+
     def test_calculate_total_balance_no_records(self):
         self.benchDAO.transactions = []
         self.assertEqual(self.benchDAO.calculate_total_balance(), 0)
 
+    def test_print_running_daily_balance(self):
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as mock_stdout:
+            BenchAPIDAO.print_running_daily_balance([DailyRunningBalance("2018-01-01", 1.5),
+                                                     DailyRunningBalance("2018-01-02", -2)])
+        self.assertEqual(mock_stdout.getvalue(),
+                         "date: 2018-01-01\trunning balance: 1.50\ndate: 2018-01-02\trunning balance: -2.00\n")
+
+    def test_calculate_running_daily_balance_no_records(self):
+        self.benchDAO.transactions = []
+        self.assertEqual(self.benchDAO.calculate_running_daily_balance(), [])
+
     def test_calculate_running_daily_balance_one_record(self):
             self.benchDAO.transactions = [Transaction("2018-01-01", "CIBC", 1.5, "Bench")]
             result = self.benchDAO.calculate_running_daily_balance()
@@ -207,6 +427,19 @@ class BenchDAOTestCase(unittest.TestCase):
         self.assertEqual(result[1].running_balance, 2)
         self.assertEqual(result[2].date, "2018-01-03")
         self.assertEqual(result[2].running_balance, 12)
+
+    def test_calculate_running_daily_balance_ends_at_total_balance(self):
+        self.benchDAO.transactions = [Transaction("2018-01-01", "CIBC", 0.1, "Bench") for _ in range(10)]
+        result = self.benchDAO.calculate_running_daily_balance()
+        self.assertEqual(result[-1].running_balance, self.benchDAO.calculate_total_balance())
+        self.assertEqual(result[-1].running_balance, 1.0)
+
+    def test_calculate_running_daily_balance_keeps_transaction_order(self):
+        transactions = [Transaction("2018-01-02", "CIBC", -4.5, "Bench"),
+                        Transaction("2018-01-01", "CIBC", 1.5, "Bench")]
+        self.benchDAO.transactions = list(transactions)
+        self.benchDAO.calculate_running_daily_balance()
+        self.assertEqual(self.benchDAO.transactions, transactions)
     
 
 if __name__ == '__main__':